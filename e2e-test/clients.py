@@ -17,28 +17,54 @@
 """Clients to make calls to FHIR Proxy, HAPI Server, and AuthZ Server."""
 
 import json
-from typing import Dict, Tuple
+import time
+from typing import List, Tuple
+import urllib.parse
 
 import requests
 
+try:
+    import orjson
 
-def _setup_session(base_url: str) -> requests.Session:
-    """Creates a request.Session instance with retry and populated header."""
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# The e2e tests issue concurrent requests to the same host, so keep enough
+# pooled connections around for them to be reused rather than discarded.
+_POOL_CONNECTIONS = 10
+_POOL_MAXSIZE = 50
+
+# Refresh the cached auth token this many seconds before it actually expires.
+_TOKEN_EXPIRY_SKEW_SECONDS = 5
+
+
+def _setup_session(base_url: str, retry_post: bool = False) -> requests.Session:
+    """Creates a request.Session instance with retry and populated header.
+
+    POST requests are only retried if `retry_post` is set, which must only be
+    done for sessions whose POSTs are idempotent (e.g., batches of searches).
+    """
     session = requests.Session()
-    retry = requests.adapters.Retry()
-    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+    allowed_methods = requests.adapters.Retry.DEFAULT_ALLOWED_METHODS
+    if retry_post:
+        allowed_methods = allowed_methods | {"POST"}
+    retry = requests.adapters.Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=allowed_methods,
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=_POOL_CONNECTIONS,
+        pool_maxsize=_POOL_MAXSIZE,
+        max_retries=retry,
+    )
     session.mount(base_url, adapter)
     session.headers.update({"Content-Type": "application/fhir+json;charset=utf-8"})
     return session
 
 
-def read_file(file_name: str) -> Dict[str, str]:
-    with open(file_name, "r") as f:
-        data = json.load(f)
-
-    return data
-
-
 class HapiClient:
     """Client for connecting to a HAPI FHIR server.
     
@@ -46,16 +72,53 @@ class HapiClient:
     """
 
     def __init__(self, host: str = "http://localhost", port: int = 8099) -> None:
-        self.base_url = "{}:{}/fhir".format(host, port)
+        self.base_url = f"{host}:{port}/fhir"
         self.session = _setup_session(self.base_url)
+        # Batch Bundles only contain searches, so they are safe to retry.
+        self._batch_session = _setup_session(self.base_url, retry_post=True)
 
     def get_resource_count(self, resource_type: str, patient_id: str) -> int:
-        resource_path = "{}/{}?subject={}&_summary=count".format(
-            self.base_url, resource_type, patient_id
+        resource_path = (
+            f"{self.base_url}/{resource_type}?subject={patient_id}&_summary=count"
         )
         response = self.session.get(resource_path)
         response.raise_for_status()
-        return response.json()["total"]
+        return _json_loads(response.content)["total"]
+
+    def batch_resource_counts(
+        self, resource_patient_pairs: List[Tuple[str, str]]
+    ) -> List[int]:
+        """Same as `get_resource_count` for many queries in one batch Bundle."""
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "batch",
+            "entry": [
+                {
+                    "request": {
+                        "method": "GET",
+                        "url": f"{resource_type}?subject={patient_id}&_summary=count",
+                    }
+                }
+                for resource_type, patient_id in resource_patient_pairs
+            ],
+        }
+        response = self._batch_session.post(self.base_url, json.dumps(bundle))
+        response.raise_for_status()
+
+        entries = _json_loads(response.content).get("entry", [])
+        if len(entries) != len(resource_patient_pairs):
+            raise ValueError(
+                f"Batch returned {len(entries)} entries for "
+                f"{len(resource_patient_pairs)} count queries"
+            )
+
+        counts = []
+        for entry in entries:
+            status = entry["response"]["status"]
+            if not status.startswith("200"):
+                raise ValueError(f"Batch count query failed: {status}")
+            counts.append(entry["resource"]["total"])
+        return counts
 
 
 class FhirProxyClient:
@@ -65,30 +128,32 @@ class FhirProxyClient:
     """
 
     def __init__(self, host: str = "http://localhost", port: int = 8080) -> None:
-        self.base_url = "{}:{}/fhir".format(host, port)
+        self.base_url = f"{host}:{port}/fhir"
         self.session = _setup_session(self.base_url)
 
     def get_resource_count(
         self, token: str, resource_search_pair: Tuple[str, str], patient_id: str
     ) -> int:
-        resource_path = "{}/{}?{}={}&_summary=count".format(
-            self.base_url, resource_search_pair[0], resource_search_pair[1], patient_id
+        resource_type, search_param = resource_search_pair
+        resource_path = (
+            f"{self.base_url}/{resource_type}?{search_param}={patient_id}"
+            "&_summary=count"
         )
-        auth_dict = {"Authorization": "Bearer {}".format(token)}
-        self.session.headers.update(auth_dict)
-
-        response = self.session.get(resource_path)
+        # Pass the token per request; mutating `self.session.headers` is not
+        # safe when the same client is shared between threads.
+        auth_dict = {"Authorization": f"Bearer {token}"}
+        response = self.session.get(resource_path, headers=auth_dict)
         response.raise_for_status()
-        return response.json()["total"]
+        return _json_loads(response.content)["total"]
 
     def post_resource(self, resource_type: str, file_name: str, token: str,) -> None:
-        auth_dict = {"Authorization": "Bearer {}".format(token)}
-        self.session.headers.update(auth_dict)
-
-        resource_path = "{}/{}".format(self.base_url, resource_type)
-        data = read_file(file_name)
+        resource_path = f"{self.base_url}/{resource_type}"
+        # The file is already FHIR JSON, so send it as is.
+        with open(file_name, "rb") as f:
+            data = f.read()
 
-        response = self.session.post(resource_path, json.dumps(data))
+        auth_dict = {"Authorization": f"Bearer {token}"}
+        response = self.session.post(resource_path, data, headers=auth_dict)
         response.raise_for_status()
 
 
@@ -106,20 +171,39 @@ class AuthClient:
         username: str = "testuser",
         password: str = "testpass",
     ) -> None:
-        self.url = "{}:{}/auth/realms/test/protocol/openid-connect/token".format(
-            host, port
+        self.url = f"{host}:{port}/auth/realms/test/protocol/openid-connect/token"
+        self.session = _setup_session(self.url)
+        self.session.headers.update(
+            {"Content-Type": "application/x-www-form-urlencoded"}
         )
-        self.client_id = client_id
-        self.username = username
-        self.password = password
-
-    def get_auth_token(self) -> str:
-        payload = {
-            "client_id": self.client_id,
-            "username": self.username,
-            "password": self.password,
-            "grant_type": "password",
-        }
-        response = requests.post(self.url, data=payload)
+        # The token request body never changes, so encode it only once.
+        self._payload = urllib.parse.urlencode(
+            {
+                "client_id": client_id,
+                "username": username,
+                "password": password,
+                "grant_type": "password",
+            }
+        )
+        self._token = None
+        self._token_expiry = 0.0
+
+    def get_auth_token(self, force_refresh: bool = False) -> str:
+        """Returns an access token, only fetching a new one when needed.
+
+        Set `force_refresh` to fetch a new token even if the cached one has not
+        expired yet, e.g., after it was rejected.
+        """
+        if (
+            not force_refresh
+            and self._token is not None
+            and time.monotonic() < self._token_expiry - _TOKEN_EXPIRY_SKEW_SECONDS
+        ):
+            return self._token
+
+        response = self.session.post(self.url, data=self._payload)
         response.raise_for_status()
-        return response.json()["access_token"]
+        token_response = response.json()
+        self._token = token_response["access_token"]
+        self._token_expiry = time.monotonic() + token_response["expires_in"]
+        return self._token
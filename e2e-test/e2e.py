@@ -16,12 +16,30 @@
 
 """End-to-end tests using the FHIR Proxy, HAPI Server, and AuthZ Server."""
 
+from concurrent import futures
 import logging
 import time
 from typing import List, Tuple
 
+import requests
+
 import clients
 
+_MAX_WORKERS = 16
+
+# Polling parameters used while waiting for a posted resource to show up.
+_INITIAL_POLL_DELAY_SECONDS = 0.1
+_MAX_POLL_DELAY_SECONDS = 5.0
+_MAX_POLL_SECONDS = 60
+
+
+def _check_counts_match(value_from_server: int, value_from_proxy: int) -> None:
+    if value_from_server != value_from_proxy:
+        error_msg = "Number of resources do not match\n\tServer: {}, Proxy: {}".format(
+            value_from_server, value_from_proxy
+        )
+        raise ValueError(error_msg)
+
 
 def test_proxy_and_server_equal_count(
     patient_list: List[str],
@@ -29,30 +47,43 @@ def test_proxy_and_server_equal_count(
     hapi: clients.HapiClient,
     fhir_proxy: clients.FhirProxyClient,
     auth: clients.AuthClient,
+    executor: futures.Executor,
 ) -> None:
     """Checks number of resources are the same via the Proxy or HAPI."""
     token = auth.get_auth_token()
-    for patient in patient_list:
-        for resource_search_pair in resource_search_pairs:
-            value_from_server = hapi.get_resource_count(
-                resource_search_pair[0], patient
-            )
-            value_from_proxy = fhir_proxy.get_resource_count(
-                token, resource_search_pair, patient
-            )
-            logging.info(
-                "%s resources returned for %s from: \n\tServer: %s, Proxy: %s",
-                resource_search_pair[0],
-                patient,
-                value_from_server,
-                value_from_proxy,
-            )
-
-            if value_from_server != value_from_proxy:
-                error_msg = "Number of resources do not match\n\tServer: {}, Proxy: {}".format(
-                    value_from_server, value_from_proxy
-                )
-                raise ValueError(error_msg)
+    jobs = [
+        (patient, resource_search_pair)
+        for patient in patient_list
+        for resource_search_pair in resource_search_pairs
+    ]
+    # All the count queries are independent, so issue them concurrently and
+    # only compare the results once every request has returned. The server
+    # counts are fetched in a single batch; the proxy ones are not, as each
+    # search should go through the proxy's access checks on its own (and the
+    # proxy only accepts transaction Bundles).
+    server_future = executor.submit(
+        hapi.batch_resource_counts,
+        [(resource_type, patient) for patient, (resource_type, _) in jobs],
+    )
+    proxy_futures = [
+        executor.submit(
+            fhir_proxy.get_resource_count, token, resource_search_pair, patient
+        )
+        for patient, resource_search_pair in jobs
+    ]
+
+    for (patient, (resource_type, _)), value_from_server, proxy_future in zip(
+        jobs, server_future.result(), proxy_futures
+    ):
+        value_from_proxy = proxy_future.result()
+        logging.info(
+            "%s resources returned for %s from: \n\tServer: %s, Proxy: %s",
+            resource_type,
+            patient,
+            value_from_server,
+            value_from_proxy,
+        )
+        _check_counts_match(value_from_server, value_from_proxy)
 
 
 def test_post_resource_increase_count(
@@ -62,19 +93,20 @@ def test_post_resource_increase_count(
     hapi: clients.HapiClient,
     fhir_proxy: clients.FhirProxyClient,
     auth: clients.AuthClient,
+    executor: futures.Executor,
 ) -> None:
     """Test to add a resource to the backend via the Proxy."""
-    token = auth_client.get_auth_token()
-    value_from_server = hapi.get_resource_count(resource_search_pair[0], patient_id)
+    # The token and the server count are independent; fetch them together.
+    token_future = executor.submit(auth.get_auth_token)
+    server_future = executor.submit(
+        hapi.get_resource_count, resource_search_pair[0], patient_id
+    )
+    token = token_future.result()
     value_from_proxy = fhir_proxy.get_resource_count(
         token, resource_search_pair, patient_id
     )
-
-    if value_from_server != value_from_proxy:
-        error_msg = "Number of resources do not match\n\tServer: {}, Proxy: {}".format(
-            value_from_server, value_from_proxy
-        )
-        raise ValueError(error_msg)
+    value_from_server = server_future.result()
+    _check_counts_match(value_from_server, value_from_proxy)
 
     current_value = value_from_proxy
     logging.info(
@@ -84,12 +116,28 @@ def test_post_resource_increase_count(
     logging.info("Adding one %s for %s", resource_search_pair[0], patient_id)
     fhir_proxy.post_resource(resource_search_pair[0], file_name, token)
 
+    delay = _INITIAL_POLL_DELAY_SECONDS
+    deadline = time.monotonic() + _MAX_POLL_SECONDS
+    value_from_proxy = fhir_proxy.get_resource_count(
+        token, resource_search_pair, patient_id
+    )
     while value_from_proxy != (current_value + 1):
-        token = auth.get_auth_token()
-        value_from_proxy = fhir_proxy.get_resource_count(
-            token, resource_search_pair, patient_id
-        )
-        time.sleep(10)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(
+                f"Timed out waiting for the new {resource_search_pair[0]}"
+            )
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, _MAX_POLL_DELAY_SECONDS)
+        try:
+            value_from_proxy = fhir_proxy.get_resource_count(
+                token, resource_search_pair, patient_id
+            )
+        except requests.HTTPError as e:
+            # The token can expire during a long wait; get a new one and retry.
+            if e.response.status_code != 401:
+                raise
+            token = auth.get_auth_token(force_refresh=True)
 
     logging.info("Added one %s for %s", resource_search_pair[0], patient_id)
     logging.info(
@@ -106,16 +154,19 @@ if __name__ == "__main__":
     fhir_proxy_client = clients.FhirProxyClient()
     hapi_client = clients.HapiClient()
 
-    logging.info("Testing proxy and server resource counts ...")
-    test_proxy_and_server_equal_count(
-        patients, resources, hapi_client, fhir_proxy_client, auth_client
-    )
-    logging.info("Testing post resource ...")
-    test_post_resource_increase_count(
-        ("Observation", "subject"),
-        "e2e-test/obs.json",
-        "Patient/75270",
-        hapi_client,
-        fhir_proxy_client,
-        auth_client,
-    )
+    # A single pool is shared by all tests to avoid recreating threads.
+    with futures.ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        logging.info("Testing proxy and server resource counts ...")
+        test_proxy_and_server_equal_count(
+            patients, resources, hapi_client, fhir_proxy_client, auth_client, executor
+        )
+        logging.info("Testing post resource ...")
+        test_post_resource_increase_count(
+            ("Observation", "subject"),
+            "e2e-test/obs.json",
+            "Patient/75270",
+            hapi_client,
+            fhir_proxy_client,
+            auth_client,
+            executor,
+        )